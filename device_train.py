@@ -1,6 +1,9 @@
 import argparse
+import copy
 import json
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import jax
 import numpy as np
@@ -18,7 +21,7 @@ from smart_open import open
 from google.cloud import storage
 from google.cloud.exceptions import NotFound
 
-from mesh_transformer.util import clip_by_global_norm, additive_weight_decay
+from mesh_transformer.util import clip_by_global_norm, additive_weight_decay, scale_by_adam_bf16_nu
 
 
 def parse_args():
@@ -42,6 +45,8 @@ def parse_args():
     parser.add_argument("--config", type=str, default=None, help="Config file location")
     parser.add_argument("--tune-model-path", type=str, default=None, help="Base model to finetune")
     parser.add_argument("--fresh-opt", default=False, action="store_true", help="Use a newly initialized optimizer, ignoring any optimizer state saved in the base checkpoint")
+    parser.add_argument("--compilation-cache", type=str, default=None, help="Directory for jax's persistent compilation cache (needs a newer jax than the pinned ~0.2.12, which has no jax.experimental.compilation_cache)")
+    parser.add_argument("--latency-hiding-scheduler", default=False, action="store_true", help="Let XLA overlap the model parallel collectives with compute (needs a libtpu that supports the flag)")
 
     args = parser.parse_args()
     return args
@@ -105,20 +110,22 @@ def save(network, step, bucket, path, mp, aux=None, keep_n=3, delete_old=True):
         json.dump(meta, f)
 
 
+def prefetch_samples(executor, dataset):
+    # the loader state is read right after the batch so a checkpoint records the batches the model has actually seen,
+    # not the one that is being prefetched
+    def get_samples():
+        return dataset.get_samples(), copy.deepcopy(dataset.get_state())
+
+    return executor.submit(get_samples)
+
+
 def train_step(network, data):
     inputs = {
         "obs": data[:, :, :-1],
         "target": data[:, :, 1:],
     }
 
-    loss, last_loss, grad_norm, grad_norm_micro = network.train(inputs)
-
-    return (
-        np.array(loss).mean(),
-        np.array(last_loss).mean(),
-        np.array(grad_norm).mean(),
-        np.array(grad_norm_micro).mean(),
-    )
+    return network.train(inputs)
 
 
 def eval_step(network, data):
@@ -137,6 +144,15 @@ if __name__ == "__main__":
     args = parse_args()
     params = json.load(open(args.config))
 
+    # libtpu reads this when the backend is first initialized, which hasn't happened yet
+    if args.latency_hiding_scheduler:
+        os.environ["LIBTPU_INIT_ARGS"] = (os.environ.get("LIBTPU_INIT_ARGS", "") + " --xla_tpu_enable_latency_hiding_scheduler=true").strip()
+
+    if args.compilation_cache is not None:
+        from jax.experimental.compilation_cache import compilation_cache
+
+        compilation_cache.initialize_cache(args.compilation_cache)
+
     gradient_accumulation_steps = params.get("gradient_accumulation_steps", 1)
     per_replica_batch = params["per_replica_batch"]
     cores_per_replica = params["cores_per_replica"]
@@ -176,7 +192,7 @@ if __name__ == "__main__":
     opt = optax.chain(
         optax.scale(1 / gradient_accumulation_steps),
         clip_by_global_norm(1),
-        optax.scale_by_adam(),
+        scale_by_adam_bf16_nu() if params.get("bf16_nu", False) else optax.scale_by_adam(),
         additive_weight_decay(weight_decay),
         optax.scale(-1),
         optax.scale_by_schedule(scheduler)
@@ -277,9 +293,9 @@ if __name__ == "__main__":
 
         print('compiling train fn')
         start = time.time()
-        loss, last_loss, grad_norm, grad_norm_micro = train_step(
+        loss, last_loss, grad_norm, grad_norm_micro = jax.device_get(train_step(
             network, train_dataset.get_samples()
-        )
+        ))
         step += 1
         print(f"Train fn compiled in {time.time() - start:.06}s")
 
@@ -296,12 +312,25 @@ if __name__ == "__main__":
         G_noise_avg = None
         S_noise_avg = None
 
+        # track the scheduler step and compute the learning rate on the host, reading it back from the optimizer state
+        # would block on the step that was just dispatched
+        sched_step = int(network.state["opt_state"][-1].count[0])
+        cpu_scheduler = jax.jit(scheduler, backend="cpu")
+
+        log_every = params.get("log_every", 10)
+        pending = []
+
+        # load the next batch on a background thread while the current step runs
+        prefetch_executor = ThreadPoolExecutor(1)
+        train_loader_state = copy.deepcopy(train_dataset.get_state())
+        next_samples = prefetch_samples(prefetch_executor, train_dataset)
+
         while True:
             if (step % ckpt_every == 1) or step == total_steps:
                 print(f"saving a checkpoint for step {step}")
                 save(network, step, bucket, model_dir,
                      mp=cores_per_replica,
-                     aux={"train_loader": train_dataset.get_state()},
+                     aux={"train_loader": train_loader_state},
                      delete_old=True,
                      )
 
@@ -323,77 +352,94 @@ if __name__ == "__main__":
                 print("training completed!")
                 exit()
 
-            start = time.time()
-            loss, last_loss, grad_norm, grad_norm_micro = train_step(
-                network, train_dataset.get_samples()
-            )
+            if not pending:
+                window_start = time.time()
+
+            # metrics stay on device until they are logged, so several train steps can be queued up without waiting
+            # for each one to finish
+            samples, train_loader_state = next_samples.result()
+            next_samples = prefetch_samples(prefetch_executor, train_dataset)
+
             step += 1
+            sched_step += 1
+            pending.append((step, sched_step, train_step(network, samples)))
+
+            # also log before anything else is logged to wandb (or the step would go backwards)
+            if len(pending) < log_every and step % ckpt_every != 1 and step % val_every != 1 and step != total_steps:
+                continue
 
-            steps_per_sec = 1 / (time.time() - start)
+            pending_metrics = jax.device_get([metrics for _, _, metrics in pending])
+            steps_per_sec = len(pending) / (time.time() - window_start)
             tokens_per_sec = tokens_per_step * steps_per_sec
-            sequences_processed = sequences_per_step * step
-            tokens_processed = tokens_per_step * step
-
-            ### compute summary stats about the gradient
-
-            # converts from grads-summed-over-microbatch (what `CasualTransformer.train` computes)
-            # to grads-averaged-over-microbatch (what we want)
-            #
-            # (when taking gradient steps, the same conversion happens inside the optimizer
-            #  via optax.scale(1 / gradient_accumulation_steps))
-            grad_norm = grad_norm / gradient_accumulation_steps
-
-            # compute G_noise and S_noise
-            # from "An Empirical Model of Large-Batch Training" Appendix A.1
-            # here, B_big = gradient_accumulation_steps, and B_small = 1 for convenience
-            gbsmall = grad_norm_micro ** 2
-            gbbig = grad_norm ** 2
-            G_noise = (gradient_accumulation_steps * gbbig - gbsmall) / (
-                gradient_accumulation_steps - 1
-            )
-            S_noise = (gbsmall - gbbig) / (1 - 1 / gradient_accumulation_steps)
-
-            noise_scale_stats = {
-                "noise/G_noise": G_noise,
-                "noise/S_noise": S_noise,
-            }
-
-            # heuristic to avoid reporting G_noise in very early training when gradients are large
-            # (these take a long time to wash out of the moving average that defines B_simple)
-            use_step_in_noise_avgs = gbbig < 2
-
-            if use_step_in_noise_avgs:
-                # compute moving averages of G_noise and S_noise, for B_simple
-                if G_noise_avg is None:
-                    G_noise_avg = G_noise
-                else:
-                    G_noise_avg = (1 - noise_scale_alpha) * G_noise_avg + noise_scale_alpha * G_noise
-
-                if S_noise_avg is None:
-                    S_noise_avg = S_noise
-                else:
-                    S_noise_avg = (1 - noise_scale_alpha) * S_noise_avg + noise_scale_alpha * S_noise
-
-                B_simple = S_noise_avg / G_noise_avg
-
-                noise_scale_stats.update(
-                    {
-                        "noise/G_noise_avg": G_noise_avg,
-                        "noise/S_noise_avg": S_noise_avg,
-                        "noise/B_simple": B_simple,
-                    }
-                )
 
-            wandb_stats = {
-                "train/loss": loss,
-                "train/last_loss": last_loss,
-                "train/steps_per_sec": steps_per_sec,
-                "train/tokens_per_sec": tokens_per_sec,
-                "train/grad_norm": grad_norm,
-                "train/learning_rate": float(scheduler(network.state["opt_state"][-1].count[0].item())),
-                "sequences_processed": sequences_processed,
-                "tokens_processed": tokens_processed,
-            }
-            wandb_stats.update(noise_scale_stats)
-
-            wandb.log(wandb_stats, step)
+            for (pending_step, pending_sched_step, _), metrics in zip(pending, pending_metrics):
+                loss, last_loss, grad_norm, grad_norm_micro = (np.array(i).mean() for i in metrics)
+
+                sequences_processed = sequences_per_step * pending_step
+                tokens_processed = tokens_per_step * pending_step
+
+                ### compute summary stats about the gradient
+
+                # converts from grads-summed-over-microbatch (what `CasualTransformer.train` computes)
+                # to grads-averaged-over-microbatch (what we want)
+                #
+                # (when taking gradient steps, the same conversion happens inside the optimizer
+                #  via optax.scale(1 / gradient_accumulation_steps))
+                grad_norm = grad_norm / gradient_accumulation_steps
+
+                # compute G_noise and S_noise
+                # from "An Empirical Model of Large-Batch Training" Appendix A.1
+                # here, B_big = gradient_accumulation_steps, and B_small = 1 for convenience
+                gbsmall = grad_norm_micro ** 2
+                gbbig = grad_norm ** 2
+                G_noise = (gradient_accumulation_steps * gbbig - gbsmall) / (
+                    gradient_accumulation_steps - 1
+                )
+                S_noise = (gbsmall - gbbig) / (1 - 1 / gradient_accumulation_steps)
+
+                noise_scale_stats = {
+                    "noise/G_noise": G_noise,
+                    "noise/S_noise": S_noise,
+                }
+
+                # heuristic to avoid reporting G_noise in very early training when gradients are large
+                # (these take a long time to wash out of the moving average that defines B_simple)
+                use_step_in_noise_avgs = gbbig < 2
+
+                if use_step_in_noise_avgs:
+                    # compute moving averages of G_noise and S_noise, for B_simple
+                    if G_noise_avg is None:
+                        G_noise_avg = G_noise
+                    else:
+                        G_noise_avg = (1 - noise_scale_alpha) * G_noise_avg + noise_scale_alpha * G_noise
+
+                    if S_noise_avg is None:
+                        S_noise_avg = S_noise
+                    else:
+                        S_noise_avg = (1 - noise_scale_alpha) * S_noise_avg + noise_scale_alpha * S_noise
+
+                    B_simple = S_noise_avg / G_noise_avg
+
+                    noise_scale_stats.update(
+                        {
+                            "noise/G_noise_avg": G_noise_avg,
+                            "noise/S_noise_avg": S_noise_avg,
+                            "noise/B_simple": B_simple,
+                        }
+                    )
+
+                wandb_stats = {
+                    "train/loss": loss,
+                    "train/last_loss": last_loss,
+                    "train/steps_per_sec": steps_per_sec,
+                    "train/tokens_per_sec": tokens_per_sec,
+                    "train/grad_norm": grad_norm,
+                    "train/learning_rate": float(cpu_scheduler(pending_sched_step)),
+                    "sequences_processed": sequences_processed,
+                    "tokens_processed": tokens_processed,
+                }
+                wandb_stats.update(noise_scale_stats)
+
+                wandb.log(wandb_stats, pending_step)
+
+            pending = []
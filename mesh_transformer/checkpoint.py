@@ -1,7 +1,9 @@
 import functools
 import io
 import json
+import re
 import time
+from collections.abc import Mapping
 
 import jax
 import jax.numpy as jnp
@@ -15,10 +17,9 @@ from mesh_transformer.util import head_print
 pieces = 16  # how many files to split each shard across
 
 
-@functools.partial(jax.jit, backend="cpu")
 def index_weights(weights, idx):
-    cpu_device = jax.devices("cpu")[0]
-    return jax.device_put(jax.tree_map(lambda i: i[idx], weights), cpu_device)
+    # index on device so only this shard is copied to the host, jitting on the cpu backend copies the whole state
+    return jax.device_get(jax.tree_map(lambda i: i[idx], weights))
 
 
 def write(x, ckpt_dir):
@@ -48,11 +49,10 @@ def write_ckpt(pytree, dir, shard):
     # ckpt_dir = Path(dir)
     # ckpt_dir.mkdir(parents=True, exist_ok=True)
 
-    flattened, structure = jax.tree_flatten(pytree)
-
     start = time.time()
     # cpu_flattened = jax.device_put(flattened, cpu_device)
-    cpu_flattened = index_weights(flattened, shard)
+    # checkpoints are always written in the legacy layout, so they stay readable by older code and conversion scripts
+    cpu_flattened = jax.tree_leaves(to_legacy_layout(index_weights(pytree, shard)))
     # print(f"Moved indexed in {time.time() - start:.06}s")
 
     cpu_flattened_chunked = split(cpu_flattened, pieces)
@@ -121,14 +121,104 @@ def reshard(x, old_shape):
     return out
 
 
+def _linear_name(layer, idx):
+    return f"{layer}/~/linear" + (f"_{idx}" if idx else "")
+
+
+def _map_layer_linears(fn, params, linear_count):
+    layer_linear = re.compile(r"(.*/layer_\d+)/~/linear(_\d+)?$")
+
+    layers = sorted({m.group(1) for m in map(layer_linear.match, params) if m})
+    new_params = {k: v for k, v in params.items() if not layer_linear.match(k)}
+
+    for layer in layers:
+        linears = [params[_linear_name(layer, i)] for i in range(linear_count)]
+        for idx, linear in enumerate(fn(*linears)):
+            new_params[_linear_name(layer, idx)] = linear
+
+    return type(params)(new_params)
+
+
+def _map_params(fn, tree):
+    # apply fn to every haiku parameter mapping in the tree (i.e. the params and the optimizer moments)
+    if isinstance(tree, Mapping):
+        if any("/~/" in k for k in tree):
+            return fn(tree)
+        return type(tree)({k: _map_params(fn, v) for k, v in tree.items()})
+    elif isinstance(tree, tuple) and hasattr(tree, "_fields"):
+        return type(tree)(*[_map_params(fn, i) for i in tree])
+    elif isinstance(tree, (tuple, list)):
+        return type(tree)([_map_params(fn, i) for i in tree])
+    else:
+        return tree
+
+
+def _fuse_layer(q, v, k, o, dense_proj, dense_proj_o):
+    qvk = {"w": np.concatenate([q["w"], v["w"], k["w"]], axis=-1)}
+    out = {"b": dense_proj_o["b"], "w": np.concatenate([o["w"], dense_proj_o["w"]], axis=-2)}
+    return [qvk, dense_proj, out]
+
+
+def _unfuse_layer(qvk, dense_proj, out):
+    dim = qvk["w"].shape[-1] // 3
+    w = qvk["w"]
+    q, v, k = {"w": w[..., :dim]}, {"w": w[..., dim:dim * 2]}, {"w": w[..., dim * 2:]}
+
+    o = {"w": out["w"][..., :dim, :]}
+    dense_proj_o = {"b": out["b"], "w": out["w"][..., dim:, :]}
+    return [q, v, k, o, dense_proj, dense_proj_o]
+
+
+def _merge_embedding(params):
+    new_params = {}
+    for k, v in params.items():
+        if k.endswith("/embedding_shard/~/linear"):
+            k = k[:-len("/~/linear")]
+        new_params[k] = {**new_params.get(k, {}), **v}
+
+    return type(params)(new_params)
+
+
+def _split_embedding(params):
+    new_params = {}
+    for k, v in params.items():
+        if k.endswith("/embedding_shard"):
+            new_params[k + "/~/linear"] = {"b": v["b"], "w": v["w"]}
+            v = {name: param for name, param in v.items() if name not in ["b", "w"]}
+            if not v:
+                continue
+        new_params[k] = v
+
+    return type(params)(new_params)
+
+
+def from_legacy_layout(pytree):
+    """Convert a checkpoint pytree with separate q, v, k and output projections in each `TransformerLayerShard` (and
+    the embedding weights in a Linear submodule) to the current layout. Only works on host (numpy) arrays."""
+    return _map_params(lambda p: _merge_embedding(_map_layer_linears(_fuse_layer, p, 6)), pytree)
+
+
+def to_legacy_layout(pytree):
+    """Inverse of `from_legacy_layout`, only uses slicing so it can be traced with `jax.eval_shape`."""
+    return _map_params(lambda p: _split_embedding(_map_layer_linears(_unfuse_layer, p, 3)), pytree)
+
+
+def cast_opt_state(template, opt_state):
+    # the optimizer decides the dtypes of its state (e.g. the bf16 second moment with bf16_nu), checkpoints only
+    # compare shapes, so one saved with a different setting would otherwise change the state's dtypes
+    return jax.tree_multimap(lambda t, x: np.asarray(x).astype(t.dtype), template, opt_state)
+
+
 def read_ckpt(pytree, dir, shards_in, shards_out=None, load_opt=True):
     if shards_out is None:
         shards_out = shards_in
 
-    old_flattened, structure = jax.tree_flatten(pytree)
-
     original_opt_state = pytree["opt_state"]
 
+    # checkpoints are stored in the legacy layout, and only converted once loaded
+    legacy_pytree = jax.eval_shape(to_legacy_layout, pytree)
+    old_flattened, structure = jax.tree_flatten(legacy_pytree)
+
     # TODO: figure out how to use a process pool here for more speed
     with multiprocessing.pool.ThreadPool(shards_in) as p:
         start = time.time()
@@ -136,6 +226,7 @@ def read_ckpt(pytree, dir, shards_in, shards_out=None, load_opt=True):
         print(f"read from disk/gcs in {time.time() - start:.06}s")
 
     def _unshard(shards, old_flattened):
+        assert len(shards[0]) == len(old_flattened), f"Incompatible checkpoints {len(shards[0])} vs {len(old_flattened)} arrays"
         unsharded = []
 
         for old, *all_shards in zip(old_flattened, *shards):
@@ -154,14 +245,16 @@ def read_ckpt(pytree, dir, shards_in, shards_out=None, load_opt=True):
         unsharded = _unshard(shards, old_flattened)
     except AssertionError:
         load_opt = False  # no opt to load in ckpt
-        del pytree['opt_state']
-        old_flattened, structure = jax.tree_flatten(pytree)
+        del legacy_pytree['opt_state']
+        old_flattened, structure = jax.tree_flatten(legacy_pytree)
         unsharded = _unshard(shards, old_flattened)
 
-    loaded_pytree = jax.tree_unflatten(structure, unsharded)
+    loaded_pytree = from_legacy_layout(jax.tree_unflatten(structure, unsharded))
 
     if not load_opt:
         loaded_pytree['opt_state'] = original_opt_state
+    else:
+        loaded_pytree['opt_state'] = cast_opt_state(original_opt_state, loaded_pytree['opt_state'])
     return loaded_pytree
 
 
@@ -226,7 +319,8 @@ def load_ckpt_v2(model_state, dir):
     head_print(f"params loaded in {time.time() - start:.06}s")
 
     start = time.time()
-    new_state["opt_state"] = parallel_read(model_state["opt_state"], dir + f"/opt_state/shard_{jax.host_id()}.npz")
+    new_state["opt_state"] = cast_opt_state(model_state["opt_state"],
+                                            parallel_read(model_state["opt_state"], dir + f"/opt_state/shard_{jax.host_id()}.npz"))
     head_print(f"opt_state loaded in {time.time() - start:.06}s")
 
     return new_state
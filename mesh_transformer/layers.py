@@ -4,7 +4,7 @@ import jax.numpy as jnp
 import numpy as np
 from einops import rearrange, repeat
 
-from mesh_transformer.util import f_psum, g_psum, maybe_shard, head_print
+from mesh_transformer.util import f_psum, g_psum, g_all_gather, maybe_shard, head_print
 from jax.experimental import PartitionSpec as P
 from jax.experimental.maps import thread_resources
 
@@ -162,6 +162,77 @@ def apply_rotary_pos_emb_v2(x, sincos):
     return (x * cos) + (rotate_every_two_v2(x) * sin)
 
 
+def blockwise_causal_attention(q, k, v, attn_bias, block_size):
+    """Causal attention computed one (query block, key block) tile at a time.
+
+    A running max and softmax denominator is kept for every query (as in FlashAttention), so the full
+    `(heads, q_len, k_len)` logits are never materialized. Key blocks entirely in the future of a query block are
+    skipped, and each query block is rematerialized in the backward pass instead of saving its logits.
+
+    Args:
+      q, k, v: `(seq, heads, dim_per_head)`, with q already scaled by `1/sqrt(dim_per_head)`
+      attn_bias: scalar, `(k_len,)` or `(heads, q_len, k_len)` attention bias
+      block_size: query and key block length, must divide `seq`
+    Returns:
+      output: `(seq, heads, dim_per_head)`
+    """
+    seq_len, heads, dim_per_head = q.shape
+    assert seq_len % block_size == 0
+    block_count = seq_len // block_size
+
+    q_blocks = q.reshape((block_count, block_size, heads, dim_per_head))
+    k_blocks = k.reshape((block_count, block_size, heads, dim_per_head))
+    v_blocks = v.reshape((block_count, block_size, heads, dim_per_head))
+    positions = jnp.arange(seq_len).reshape((block_count, block_size))
+
+    # only slice the bias along the axes it actually varies over
+    attn_bias = jnp.asarray(attn_bias)
+    attn_bias = attn_bias.reshape((1,) * (3 - attn_bias.ndim) + attn_bias.shape)
+    bias_sizes = tuple(min(i, block_size) for i in attn_bias.shape[1:])
+
+    @jax.checkpoint
+    def attend_query_block(q_idx):
+        q_block = q_blocks[q_idx]
+        q_pos = positions[q_idx]
+
+        def attend_key_block(carry, k_idx):
+            def update(carry):
+                out, row_max, row_sum = carry
+                k_pos = positions[k_idx]
+
+                logits = jnp.einsum("thd,Thd->htT", q_block, k_blocks[k_idx])
+
+                bias_starts = tuple(idx * block_size if size > 1 else 0
+                                    for idx, size in zip((q_idx, k_idx), attn_bias.shape[1:]))
+                logits += jax.lax.dynamic_slice(attn_bias, (0,) + bias_starts, attn_bias.shape[:1] + bias_sizes)
+                logits = jnp.where(q_pos[:, None] >= k_pos[None, :], logits, -1e10).astype(jnp.float32)
+
+                # the result is invariant to the shift, so no gradient needs to flow through the running max
+                new_max = jax.lax.stop_gradient(jnp.maximum(row_max, logits.max(-1)))
+                correction = jnp.exp(row_max - new_max)
+                weights = jnp.exp(logits - new_max[:, :, None])
+
+                row_sum = row_sum * correction + weights.sum(-1)
+                out = out * correction[:, :, None] + jnp.einsum("htT,Thd->htd", weights.astype(v.dtype),
+                                                                v_blocks[k_idx]).astype(jnp.float32)
+                return out, new_max, row_sum
+
+            return jax.lax.cond(k_idx <= q_idx, update, lambda c: c, carry), None
+
+        init = (jnp.zeros((heads, block_size, dim_per_head), dtype=jnp.float32),
+                jnp.full((heads, block_size), -jnp.inf, dtype=jnp.float32),
+                jnp.zeros((heads, block_size), dtype=jnp.float32))
+
+        (out, _, row_sum), _ = jax.lax.scan(attend_key_block, init, jnp.arange(block_count))
+
+        return (out / row_sum[:, :, None]).astype(v.dtype)
+
+    # [block_count, heads, block_size, dim_per_head]
+    out = jax.lax.map(attend_query_block, jnp.arange(block_count))
+
+    return jnp.transpose(out, (0, 2, 1, 3)).reshape((seq_len, heads, dim_per_head))
+
+
 class EmbeddingShard(hk.Module):
     def __init__(self, config, name=None):
         super().__init__(name=name)
@@ -182,20 +253,25 @@ class EmbeddingShard(hk.Module):
         else:
             self.positional_embeddings = None
 
-        self.proj = hk.Linear(self.out_dim, w_init=hk.initializers.TruncatedNormal(stddev=1 / np.sqrt(in_dim)))
+        self.embed_init = hk.initializers.TruncatedNormal(stddev=1 / np.sqrt(in_dim))
 
     def __call__(self, x, dtype=jnp.bfloat16):
         shard_start_index = jax.lax.axis_index('shard') * self.in_dim_per_shard
 
-        input_onehot = jax.nn.one_hot(x - shard_start_index, self.in_dim_per_shard)
-        proj_out = self.proj(input_onehot)
+        embed = hk.get_parameter("w", [self.in_dim_per_shard, self.out_dim], init=self.embed_init)
+        bias = hk.get_parameter("b", [self.out_dim], init=jnp.zeros)
+
+        # gather the tokens which fall in this shard's slice of the vocab instead of doing a one hot matmul
+        local_index = x.astype(jnp.int32) - shard_start_index
+        in_shard = (local_index >= 0) & (local_index < self.in_dim_per_shard)
+
+        proj_out = jnp.take(embed, jnp.clip(local_index, 0, self.in_dim_per_shard - 1), axis=0)
+        proj_out = jnp.where(in_shard[..., None], proj_out, 0).astype(jnp.float32) + bias
 
         proj_out = g_psum(proj_out)
 
         if self.positional_embeddings is not None:
-            all_pos_embed = jax.lax.all_gather(self.positional_embeddings, 'shard')
-
-            all_pos_embed = hk.Flatten()(jnp.transpose(all_pos_embed, (1, 0, 2)))
+            all_pos_embed = jax.lax.all_gather(self.positional_embeddings, 'shard', axis=-1, tiled=True)
 
             proj_out += all_pos_embed
 
@@ -240,24 +316,24 @@ class TransformerLayerShard(hk.Module):
 
         self.dim = dim
         self.dim_per_head = dim // heads
+        self.scale = float(1 / np.sqrt(self.dim_per_head))
         self.heads_per_shard = heads // shards
         self.dim_per_shard = dim // shards
         self.pe_rotary_dims = config.get("pe_rotary_dims", self.dim_per_head)
+        self.attn_block_size = config.get("attn_block_size", None)
 
         self.norm = norm
 
-        self.q = hk.Linear(self.dim_per_shard, with_bias=False)
-        self.v = hk.Linear(self.dim_per_shard, with_bias=False)
-        self.k = hk.Linear(self.dim_per_shard, with_bias=False)
-
-        self.o = hk.Linear(self.dim, with_bias=False,
-                           w_init=hk.initializers.TruncatedNormal(stddev=init_scale / np.sqrt(self.dim)))
+        # q, v and k are projected with one matmul
+        self.qvk = hk.Linear(self.dim_per_shard * 3, with_bias=False)
 
         self.dense_proj = hk.Linear(self.dim_per_shard * 4)
-        self.dense_proj_o = hk.Linear(self.dim,
-                                      w_init=hk.initializers.TruncatedNormal(stddev=init_scale / np.sqrt(self.dim)))
 
-    def self_attn(self, q, v, k, attn_bias):
+        # as are the attention and feedforward outputs
+        self.out = hk.Linear(self.dim,
+                             w_init=hk.initializers.TruncatedNormal(stddev=init_scale / np.sqrt(self.dim)))
+
+    def self_attn(self, q, v, k, attn_bias, causal=False):
         if self.is_rotary:
             k_rot = k[:, :, :self.pe_rotary_dims]
             k_pass = k[:, :, self.pe_rotary_dims:]
@@ -272,27 +348,49 @@ class TransformerLayerShard(hk.Module):
             k = jnp.concatenate([k_rot, k_pass], axis=-1)
             q = jnp.concatenate([q_rot, q_pass], axis=-1)
 
-        attention_logits = jnp.einsum("thd,Thd->htT", q, k)
+        if causal:
+            seq_len = q.shape[0]
+
+            if self.attn_block_size is not None and seq_len % self.attn_block_size == 0:
+                attention_vec = blockwise_causal_attention(q, k, v, attn_bias, self.attn_block_size)
+                return attention_vec.reshape((-1, self.dim_per_shard))
 
-        sqrt_key_size = np.sqrt(self.dim_per_head).astype(k.dtype)
-        attention_logits = attention_logits / sqrt_key_size
+        # heads first, so the heads are the leading batch dim of both attention matmuls
+        q = jnp.transpose(q, (1, 0, 2))
+        v = jnp.transpose(v, (1, 0, 2))
+        k = jnp.transpose(k, (1, 0, 2))
+
+        attention_logits = jnp.einsum("htd,hTd->htT", q, k)
 
         attention_logits += attn_bias
 
+        if causal:
+            # mask from positions instead of a (seq, seq) bias constant, so it fuses into the softmax
+            q_pos = jnp.arange(seq_len)[:, None]
+            k_pos = jnp.arange(seq_len)[None, :]
+            attention_logits = jnp.where(q_pos >= k_pos, attention_logits, -1e10)
+
         attention_weights = jax.nn.softmax(attention_logits)
-        attention_vec = jnp.einsum("htT,Thd->thd", attention_weights, v).reshape((-1, self.dim_per_shard))
+        attention_vec = jnp.einsum("htT,hTd->htd", attention_weights, v)
+        attention_vec = jnp.transpose(attention_vec, (1, 0, 2)).reshape((-1, self.dim_per_shard))
 
-        return self.o(attention_vec)
+        return attention_vec
 
     def ff(self, x):
         dense_proj = self.dense_proj(x)
-        dense_proj = jax.nn.gelu(dense_proj)
-        return self.dense_proj_o(dense_proj)
+        return jax.nn.gelu(dense_proj)
+
+    def output(self, attn_out, dense_out):
+        out = jnp.concatenate([attn_out, dense_out], axis=-1)
+        return g_psum(self.out(out))
 
     def qvk_proj(self, x):
-        q = self.q(x).reshape(x.shape[:-1] + (self.heads_per_shard, self.dim_per_head))
-        v = self.v(x).reshape(x.shape[:-1] + (self.heads_per_shard, self.dim_per_head))
-        k = self.k(x).reshape(x.shape[:-1] + (self.heads_per_shard, self.dim_per_head))
+        q, v, k = jnp.split(self.qvk(x), 3, axis=-1)
+
+        # scale q here rather than the (heads, seq, seq) logits
+        q = q.reshape(x.shape[:-1] + (self.heads_per_shard, self.dim_per_head)) * jnp.asarray(self.scale, x.dtype)
+        v = v.reshape(x.shape[:-1] + (self.heads_per_shard, self.dim_per_head))
+        k = k.reshape(x.shape[:-1] + (self.heads_per_shard, self.dim_per_head))
 
         return q, v, k
 
@@ -302,15 +400,10 @@ class TransformerLayerShard(hk.Module):
 
         q, v, k = self.qvk_proj(x)
 
-        seq_len = x.shape[0]
-        causal_mask = np.tril(np.ones((seq_len, seq_len)))
-        bias = -1e10 * (1. - causal_mask)
-        bias += attn_bias
-
-        attn_out = self.self_attn(q, v, k, bias)
+        attn_out = self.self_attn(q, v, k, attn_bias, causal=True)
         dense_out = self.ff(x)
 
-        return g_psum(attn_out + dense_out)
+        return self.output(attn_out, dense_out)
 
     # iterate the decoding process by a single token
     def decode_once(self, decode_state, x, attn_bias):
@@ -325,20 +418,12 @@ class TransformerLayerShard(hk.Module):
         v = jnp.concatenate((decode_state["v"], v), axis=0)[1:]
         k = jnp.concatenate((decode_state["k"], k), axis=0)[1:]
 
-        tokens_decoded = decode_state["tokens_decoded"] + 1
-        length = v.shape[0]
-
-        masked_tokens = length - tokens_decoded
-
-        attention_mask = jnp.arange(0, length) < masked_tokens
-        bias = (-1e10 * attention_mask)
-        bias += attn_bias
-
-        attn_out = self.self_attn(q, v, k, bias)
+        # attn_bias already masks out the tokens before the context starts
+        attn_out = self.self_attn(q, v, k, attn_bias)
         dense_out = self.ff(x)
 
-        return g_psum(attn_out + dense_out), {
-            "tokens_decoded": tokens_decoded,
+        return self.output(attn_out, dense_out), {
+            "tokens_decoded": decode_state["tokens_decoded"] + 1,
             "k": k,
             "v": v
         }
@@ -350,20 +435,11 @@ class TransformerLayerShard(hk.Module):
 
         q, v, k = self.qvk_proj(x)
 
-        full_length = x.shape[0]
-        masked_tokens = full_length - given_length
-
-        seq_len = x.shape[0]
-        causal_mask = np.tril(np.ones((seq_len, seq_len)))
-
-        bias = -1e10 * (1. - causal_mask)  # regular AR masking
-        bias -= 1e10 * (jnp.arange(0, full_length) < masked_tokens)  # mask out zero tokens before context starts
-        bias += attn_bias  # finally add attn bias for rpe
-
-        attn_out = self.self_attn(q, v, k, bias)
+        # attn_bias already masks out the zero tokens before the context starts
+        attn_out = self.self_attn(q, v, k, attn_bias, causal=True)  # regular AR masking
         dense_out = self.ff(x)
 
-        return g_psum(attn_out + dense_out), {"k": k, "v": v, "tokens_decoded": given_length.astype(jnp.uint32)}
+        return self.output(attn_out, dense_out), {"k": k, "v": v, "tokens_decoded": given_length.astype(jnp.uint32)}
 
 
 # This new class combines the input and output projection into one matmul for better efficiency
@@ -374,6 +450,7 @@ class TransformerLayerShardV2(hk.Module):
         self.n_head = config["n_heads"]
         self.d_head = config["d_head"]
         self.d_rotary = config["pe_rotary_dims"]
+        self.scale = float(1 / np.sqrt(self.d_head))
         self.mp_num = thread_resources.env.shape['mp']
 
         self.norm = hk.LayerNorm(-1, True, True)
@@ -404,9 +481,6 @@ class TransformerLayerShardV2(hk.Module):
 
         attention_logits = maybe_shard(attention_logits, P("dp", "mp", None, None))
 
-        sqrt_key_size = np.sqrt(self.d_head).astype(k.dtype)
-        attention_logits = attention_logits / sqrt_key_size
-
         attention_logits += attn_bias
         attention_logits = maybe_shard(attention_logits, P("dp", "mp", None, None))
 
@@ -444,7 +518,8 @@ class TransformerLayerShardV2(hk.Module):
 
         q, v, k, ff = jnp.split(mp_split, [local_dim, local_dim * 2, local_dim * 3], axis=-1)
 
-        q = self.head_split(q)
+        # scale q here rather than the (batch, heads, seq, seq) logits
+        q = self.head_split(q * jnp.asarray(self.scale, x.dtype))
         v = self.head_split(v)
         k = self.head_split(k)
 
@@ -554,9 +629,8 @@ class ProjectionShard(hk.Module):
         x = self.norm(x)
         proj = self.proj(x)
 
-        all_proj = jax.lax.all_gather(proj, 'shard')
-
-        return hk.Flatten()(jnp.transpose(all_proj, (1, 0, 2)))
+        # gathers straight into (..., vocab), so no transpose + flatten is needed
+        return jax.lax.all_gather(proj, 'shard', axis=-1, tiled=True)
 
     def loss(self, x, targets, z_loss=1):
         x = f_psum(x)
@@ -564,17 +638,27 @@ class ProjectionShard(hk.Module):
         logits = self.proj(x)
 
         shard_start_index = jax.lax.axis_index('shard') * self.dim_per_shard
-        global_max = jax.lax.pmax(jax.lax.stop_gradient(logits.max(-1, keepdims=True)), "shard")
-        logits -= jax.lax.stop_gradient(global_max)
 
-        gt_onehot = jax.nn.one_hot(targets - shard_start_index, self.dim_per_shard)
-        predicted_logits = jnp.sum(jnp.multiply(gt_onehot, logits), axis=-1)
-        predicted_logits = g_psum(predicted_logits)
+        # gather the target logits which fall in this shard's slice of the vocab instead of using a one hot
+        local_targets = targets.astype(jnp.int32) - shard_start_index
+        in_shard = (local_targets >= 0) & (local_targets < self.dim_per_shard)
 
-        exp_logits = jnp.exp(logits)
+        predicted_logits = jnp.take_along_axis(logits,
+                                               jnp.clip(local_targets, 0, self.dim_per_shard - 1)[..., None],
+                                               axis=-1)[..., 0]
+        predicted_logits = jnp.where(in_shard, predicted_logits, 0)
 
-        sum_exp_logits = exp_logits.sum(axis=-1)
-        sum_exp_logits = g_psum(sum_exp_logits)
+        local_max = jax.lax.stop_gradient(logits.max(-1))
+        sum_exp_logits = jnp.exp(logits - local_max[..., None]).sum(axis=-1)
+
+        # a single collective for the max, softmax denominator and target logit of every shard, then rescale the
+        # denominators to the global max
+        all_max, all_sum_exp_logits, all_predicted_logits = jnp.moveaxis(
+            g_all_gather(jnp.stack([local_max, sum_exp_logits, predicted_logits])), 1, 0)
+        global_max = all_max.max(0)
+
+        sum_exp_logits = jnp.sum(all_sum_exp_logits * jnp.exp(all_max - global_max), axis=0)
+        predicted_logits = all_predicted_logits.sum(0) - global_max
 
         loss = jnp.log(sum_exp_logits) - predicted_logits
 
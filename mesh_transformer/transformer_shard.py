@@ -44,6 +44,13 @@ class CausalTransformerShard(hk.Module):
         else:
             self.rpe = None
 
+        # e.g. "dots_with_no_batch_dims_saveable" to keep matmul outputs and only recompute the cheap elementwise ops
+        remat_policy = config.get("remat_policy", None)
+        if remat_policy is not None:
+            self.remat = partial(hk.remat, policy=getattr(jax.checkpoint_policies, remat_policy))
+        else:
+            self.remat = hk.remat
+
     def eval(self, context, target, z_loss=0., mask=0.0):
         input_len = context.shape[0]
 
@@ -54,10 +61,10 @@ class CausalTransformerShard(hk.Module):
 
         attn_bias += mask
 
-        x = hk.remat(self.embed)(context)
+        x = self.embed(context)
 
         for l in self.transformer_layers:
-            x = x + hk.remat(l)(x, attn_bias)
+            x = x + self.remat(l)(x, attn_bias)
 
         return hk.remat(self.proj.loss)(x, target, z_loss)
 
@@ -83,6 +90,9 @@ class CausalTransformerShard(hk.Module):
         else:
             attn_bias = 0
 
+        # mask out zero tokens before context starts, once for all layers
+        attn_bias += -1e10 * (jnp.arange(0, input_len) < input_len - (length - 1))
+
         x = self.embed(context)
 
         states = []
@@ -103,6 +113,10 @@ class CausalTransformerShard(hk.Module):
         else:
             attn_bias = 0
 
+        # every layer has decoded the same number of tokens, so the context mask is shared by all of them
+        tokens_decoded = state[0]["tokens_decoded"] + 1
+        attn_bias += -1e10 * (jnp.arange(0, input_len) < input_len - tokens_decoded)
+
         x = self.embed(new_tok)
 
         new_states = []
@@ -140,11 +154,14 @@ class CausalTransformer:
 
             train_loss_fn = hk.without_apply_rng(hk.transform(train_loss)).apply
 
+            # cast once, not for every microbatch
+            bf16_params = to_bf16(state["params"])
+
             def microbatch(old_grad, batch):
                 ctx, tgt = batch
 
                 val_grad_fn = jax.value_and_grad(train_loss_fn, has_aux=True)
-                (loss, last_loss), grad = val_grad_fn(to_bf16(state["params"]), ctx, tgt)
+                (loss, last_loss), grad = val_grad_fn(bf16_params, ctx, tgt)
 
                 new_grad = jax.tree_multimap(lambda a, b: a + b, old_grad, grad)
                 gnorm = global_norm(grad)
@@ -152,12 +169,12 @@ class CausalTransformer:
 
             if ctx.shape[0] == 1:
                 val_grad_fn = jax.value_and_grad(train_loss_fn, has_aux=True)
-                (loss, last_loss), grad = val_grad_fn(to_bf16(state["params"]), ctx[0], tgt[0])
+                (loss, last_loss), grad = val_grad_fn(bf16_params, ctx[0], tgt[0])
                 gnorm = global_norm(grad)
             else:
                 grad, (loss, last_loss, gnorm) = jax.lax.scan(microbatch,
                                                        jax.tree_map(lambda x: jnp.zeros_like(x).astype(jnp.bfloat16),
-                                                                    state["params"]),
+                                                                    bf16_params),
                                                        (ctx, tgt))
 
             grad_norm_micro = jax.lax.pmean(gnorm, "batch")
@@ -289,8 +306,8 @@ class CausalTransformer:
         # print("train iter")
         # print("sample", sample["obs"])
         # print("target", sample["target"])
-        obs = jnp.transpose(sample["obs"], (1, 0, 2))
-        target = jnp.transpose(sample["target"], (1, 0, 2))
+        obs = np.transpose(sample["obs"], (1, 0, 2))
+        target = np.transpose(sample["target"], (1, 0, 2))
 
         # print("train sample", obs.shape)
         # print("train target", target.shape)
@@ -299,9 +316,9 @@ class CausalTransformer:
 
         # start = time.time()
         loss, last_loss, grad_norm, grad_norm_micro, self.state = self.train_xmap(self.state, obs, target)
-        loss = np.array(loss)
-        last_loss = np.array(last_loss)
-        grad_norm = np.array(grad_norm)
+
+        # these stay on device so the next step can be dispatched before this one finishes, converting them to numpy
+        # blocks until the step is done
         # print(f"iter done in {time.time() - start:.06}s")
         return loss.mean(), last_loss.mean(), grad_norm.mean(), grad_norm_micro.mean()
 
@@ -1,7 +1,7 @@
 import jax
 import jax.numpy as jnp
 from jax.experimental.pjit import with_sharding_constraint
-from optax import AdditiveWeightDecayState, GradientTransformation, OptState
+from optax import AdditiveWeightDecayState, GradientTransformation, OptState, ScaleByAdamState
 
 
 # same as with_sharding_constraint but doesn't fail if run outside of pjit/mesh context
@@ -84,6 +84,50 @@ def additive_weight_decay(weight_decay: float = 0.0) -> GradientTransformation:
     return GradientTransformation(init_fn, update_fn)
 
 
+def scale_by_adam_bf16_nu(b1: float = 0.9,
+                          b2: float = 0.999,
+                          eps: float = 1e-8,
+                          eps_root: float = 0.0) -> GradientTransformation:
+    """Same as `optax.scale_by_adam`, but stores the second moment in bf16 to save optimizer state memory.
+
+    The first moment stays in fp32, and the update itself is computed in fp32. The second moment is stochastically
+    rounded to bf16: with the usual b2, each step changes it by less than bf16's resolution, so rounding to nearest
+    would leave it stuck at its old value.
+
+    Args:
+      b1: decay rate for the exponentially weighted average of grads.
+      b2: decay rate for the exponentially weighted average of squared grads.
+      eps: term added to the denominator to improve numerical stability.
+      eps_root: term added to the denominator inside the square-root.
+
+    Returns:
+      An (init_fn, update_fn) tuple.
+    """
+
+    def init_fn(params):
+        mu = jax.tree_map(lambda t: jnp.zeros_like(t, dtype=jnp.float32), params)
+        nu = jax.tree_map(lambda t: jnp.zeros_like(t, dtype=jnp.bfloat16), params)
+        return ScaleByAdamState(count=jnp.zeros([], jnp.int32), mu=mu, nu=nu)
+
+    def update_fn(updates, state, params=None):
+        del params
+        updates = to_f32(updates)
+        mu = jax.tree_multimap(lambda g, t: (1 - b1) * g + b1 * t, updates, state.mu)
+        nu = jax.tree_multimap(lambda g, t: (1 - b2) * (g ** 2) + b2 * t, updates, to_f32(state.nu))
+        count = state.count + 1
+        mu_hat = jax.tree_map(lambda t: t / (1 - b1 ** count), mu)
+        nu_hat = jax.tree_map(lambda t: t / (1 - b2 ** count), nu)
+        updates = jax.tree_multimap(lambda m, v: m / (jnp.sqrt(v + eps_root) + eps), mu_hat, nu_hat)
+
+        nu_leaves, nu_treedef = jax.tree_flatten(nu)
+        keys = jax.random.split(jax.random.fold_in(jax.random.PRNGKey(0), count), len(nu_leaves))
+        nu = jax.tree_unflatten(nu_treedef, [stochastic_round_bf16(t, k) for t, k in zip(nu_leaves, keys)])
+
+        return updates, ScaleByAdamState(count=count, mu=mu, nu=nu)
+
+    return GradientTransformation(init_fn, update_fn)
+
+
 def to_f32(t):
     return jax.tree_map(lambda x: x.astype(jnp.float32) if x.dtype == jnp.bfloat16 else x, t)
 
@@ -92,6 +136,15 @@ def to_bf16(t):
     return jax.tree_map(lambda x: x.astype(jnp.bfloat16) if x.dtype == jnp.float32 else x, t)
 
 
+def stochastic_round_bf16(x, key):
+    # add random bits below bf16's mantissa before truncating, so x is rounded up with probability proportional to
+    # its distance from the lower bf16 value and small increments survive on average
+    bits = jax.lax.bitcast_convert_type(x.astype(jnp.float32), jnp.uint32)
+    noise = jax.random.randint(key, x.shape, 0, 1 << 16, dtype=jnp.int32).astype(jnp.uint32)
+    bits = (bits + noise) & jnp.uint32(0xFFFF0000)
+    return jax.lax.bitcast_convert_type(bits, jnp.float32).astype(jnp.bfloat16)
+
+
 def to_f16(t):
     return jax.tree_map(lambda x: x.astype(jnp.float16) if x.dtype == jnp.float32 else x, t)
 
@@ -147,6 +200,23 @@ def g_psum_bwd(_, g):
 g_psum.defvjp(g_psum_fwd, g_psum_bwd)
 
 
+# all_gather in forward pass, slice out the local shard in backward
+@jax.custom_vjp
+def g_all_gather(x):
+    return jax.lax.all_gather(x, "shard")
+
+
+def g_all_gather_fwd(x):
+    return g_all_gather(x), None
+
+
+def g_all_gather_bwd(_, g):
+    return g[jax.lax.axis_index("shard")],
+
+
+g_all_gather.defvjp(g_all_gather_fwd, g_all_gather_bwd)
+
+
 def shard_axis(x, axis_size, axis_name):
     # in_shape = x.shape
     assert x.shape[0] % axis_size == 0
@@ -178,9 +248,41 @@ def head_print(*args, **kwargs):
         print(*args, **kwargs)
 
 
+def check_scale_by_adam_bf16_nu(steps=5000, size=4096):
+    # compare against fp32 adam, with the gradient scale rising and then falling over the run
+    from optax import scale_by_adam
+
+    fp32_adam = scale_by_adam()
+    bf16_nu_adam = scale_by_adam_bf16_nu()
+
+    def step(carry, i):
+        fp32_state, bf16_nu_state = carry
+        scale = jnp.where(i < steps // 2, 0.1 + i / steps, 1.1 - i / steps)
+        grads = scale * jax.random.normal(jax.random.fold_in(jax.random.PRNGKey(1), i), (size,))
+
+        fp32_updates, fp32_state = fp32_adam.update(grads, fp32_state)
+        bf16_nu_updates, bf16_nu_state = bf16_nu_adam.update(grads, bf16_nu_state)
+
+        update_err = jnp.abs(bf16_nu_updates - fp32_updates).mean() / jnp.abs(fp32_updates).mean()
+        nu = to_f32(bf16_nu_state.nu)
+        sqrt_nu_err = jnp.mean(jnp.abs(jnp.sqrt(nu) - jnp.sqrt(fp32_state.nu)) / jnp.sqrt(fp32_state.nu))
+        mean_nu_err = jnp.abs(nu.mean() - fp32_state.nu.mean()) / fp32_state.nu.mean()
+        return (fp32_state, bf16_nu_state), (update_err, sqrt_nu_err, mean_nu_err)
+
+    params = jnp.zeros((size,))
+    _, (update_err, sqrt_nu_err, mean_nu_err) = jax.jit(lambda: jax.lax.scan(
+        step, (fp32_adam.init(params), bf16_nu_adam.init(params)), jnp.arange(steps)))()
+
+    print(f"max relative error over {steps} steps: updates {update_err.max():.4f}, sqrt(nu) {sqrt_nu_err.max():.4f}, "
+          f"mean nu {mean_nu_err.max():.4f}")
+    assert update_err.max() < 0.05 and sqrt_nu_err.max() < 0.05 and mean_nu_err.max() < 0.01
+
+
 if __name__ == "__main__":
     sch = gpt3_schedule(1_000, 20_000, 1e-4, 1e-5)
 
     for i in range(150):
         i = i * 200
         print(i, sch(i))
+
+    check_scale_by_adam_bf16_nu()